@@ -1,18 +1,22 @@
+from collections import OrderedDict
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.autograd import Variable
-
-import numpy as np
+from torch.utils.checkpoint import checkpoint
 
 from VectorQuantiser import VectorQuantiserEMA
 
 from utils import get_prior, straight_through_round
 
+# log2(e), converts the prior's cross entropy from nats to bits
+LOG2_E = 1.4426950408889634
+
 
 class Residual(nn.Module):
-    def __init__(self, in_channels, num_hiddens, num_residual_hiddens):
+    def __init__(self, in_channels, num_hiddens, num_residual_hiddens, use_checkpoint=False):
         super(Residual, self).__init__()
+        self.use_checkpoint = use_checkpoint
         self._block = nn.Sequential(
             nn.ReLU(True),
             nn.Conv2d(in_channels=in_channels,
@@ -23,113 +27,108 @@ class Residual(nn.Module):
                       out_channels=num_hiddens,
                       kernel_size=1, stride=1, bias=False)
         )
+
+    def _block_tail(self, x):
+        # _block without its leading in-place ReLU
+        return self._block[3](self._block[2](self._block[1](x)))
     
     def forward(self, x):
+        if self.training and self.use_checkpoint:
+            # The block's leading in-place ReLU also rectifies x, so apply it here instead of mutating a checkpoint input
+            x = F.relu(x)
+            return x + checkpoint(self._block_tail, x, use_reentrant=False)
         return x + self._block(x)
 
 
 class ResidualStack(nn.Module):
-    def __init__(self, in_channels, num_hiddens, num_residual_layers, num_residual_hiddens):
+    def __init__(self, in_channels, num_hiddens, num_residual_layers, num_residual_hiddens, use_checkpoint=False):
         super(ResidualStack, self).__init__()
-        self._num_residual_layers = num_residual_layers
-        self._layers = nn.ModuleList([Residual(in_channels, num_hiddens, num_residual_hiddens)
-                             for _ in range(self._num_residual_layers)])
+        self._layers = nn.Sequential(*[Residual(in_channels, num_hiddens, num_residual_hiddens, use_checkpoint)
+                             for _ in range(num_residual_layers)])
 
     def forward(self, x):
-        for i in range(self._num_residual_layers):
-            x = self._layers[i](x)
-        return F.relu(x)
-
-class Encoder(nn.Module):
-    def __init__(self, in_channels, num_hiddens, num_residual_layers, num_residual_hiddens):
-        super(Encoder, self).__init__()
-
-        self._conv_1 = nn.Conv2d(in_channels=in_channels,
-                                 out_channels=num_hiddens//2,
-                                 kernel_size=4,
-                                 stride=2, padding=1)
-
-        self._conv_2 = nn.Conv2d(in_channels=num_hiddens//2,
-                                 out_channels=num_hiddens,
-                                 kernel_size=4,
-                                 stride=2, padding=1)
-
-        self._conv_3 = nn.Conv2d(in_channels=num_hiddens,
-                                 out_channels=num_hiddens,
-                                 kernel_size=4,
-                                 stride=1, padding=2)
-
-        self._conv_4 = nn.Conv2d(in_channels=num_hiddens,
-                                 out_channels=num_hiddens,
-                                 kernel_size=3,
-                                 stride=1, padding=1)
-
-        self._residual_stack = ResidualStack(in_channels=num_hiddens,
-                                             num_hiddens=num_hiddens,
-                                             num_residual_layers=num_residual_layers,
-                                             num_residual_hiddens=num_residual_hiddens)
-
-    def forward(self, inputs):
-        x = self._conv_1(inputs)
-        x = F.relu(x)
-        
-        x = self._conv_2(x)
-        x = F.relu(x)
-        
-        x = self._conv_3(x)
-        x = F.relu(x)
-
-        x = self._conv_4(x)
-        #Should have 2048 units -> embedding_dim * repres_dim^2
-        return self._residual_stack(x)
-
-
-class Decoder(nn.Module):
-    def __init__(self, in_channels, out_channels, num_hiddens, num_residual_layers, num_residual_hiddens):
-        super(Decoder, self).__init__()
-        
-        self._conv_1 = nn.Conv2d(in_channels=in_channels,
-                                 out_channels=num_hiddens,
-                                 kernel_size=3, 
-                                 stride=1, padding=1)
-        
-        self._residual_stack = ResidualStack(in_channels=num_hiddens,
-                                             num_hiddens=num_hiddens,
-                                             num_residual_layers=num_residual_layers,
-                                             num_residual_hiddens=num_residual_hiddens)
-        
-        self._conv_trans_1 = nn.ConvTranspose2d(in_channels=num_hiddens, 
-                                                out_channels=num_hiddens//2,
-                                                kernel_size=4, 
-                                                stride=1, padding=2)
-
-        self._conv_trans_2 = nn.ConvTranspose2d(in_channels=num_hiddens//2, 
-                                                out_channels=num_hiddens//2,
-                                                kernel_size=4, 
-                                                stride=2, padding=1)
-
-        self._conv_trans_3 = nn.ConvTranspose2d(in_channels=num_hiddens//2, 
-                                                out_channels=out_channels,
-                                                kernel_size=4, 
-                                                stride=2, padding=1)
-
-    def forward(self, inputs):
-        x = self._conv_1(inputs)
-        
-        x = self._residual_stack(x)
-        
-        x = self._conv_trans_1(x)
-        x = F.relu(x)
-
-        x = self._conv_trans_2(x)
-        x = F.relu(x)
-        
-        return self._conv_trans_3(x)
+        return F.relu(self._layers(x))
+
+class Encoder(nn.Sequential):
+    # Layer names match the original attributes so existing checkpoints still load
+    def __init__(self, in_channels, num_hiddens, num_residual_layers, num_residual_hiddens, use_checkpoint=False):
+        super(Encoder, self).__init__(OrderedDict([
+            ('_conv_1', nn.Conv2d(in_channels=in_channels,
+                                  out_channels=num_hiddens//2,
+                                  kernel_size=4,
+                                  stride=2, padding=1)),
+            ('_relu_1', nn.ReLU(True)),
+
+            ('_conv_2', nn.Conv2d(in_channels=num_hiddens//2,
+                                  out_channels=num_hiddens,
+                                  kernel_size=4,
+                                  stride=2, padding=1)),
+            ('_relu_2', nn.ReLU(True)),
+
+            ('_conv_3', nn.Conv2d(in_channels=num_hiddens,
+                                  out_channels=num_hiddens,
+                                  kernel_size=4,
+                                  stride=1, padding=2)),
+            ('_relu_3', nn.ReLU(True)),
+
+            ('_conv_4', nn.Conv2d(in_channels=num_hiddens,
+                                  out_channels=num_hiddens,
+                                  kernel_size=3,
+                                  stride=1, padding=1)),
+
+            #Should have 2048 units -> embedding_dim * repres_dim^2
+            ('_residual_stack', ResidualStack(in_channels=num_hiddens,
+                                              num_hiddens=num_hiddens,
+                                              num_residual_layers=num_residual_layers,
+                                              num_residual_hiddens=num_residual_hiddens,
+                                              use_checkpoint=use_checkpoint))
+        ]))
+
+
+class Decoder(nn.Sequential):
+    def __init__(self, in_channels, out_channels, num_hiddens, num_residual_layers, num_residual_hiddens, use_checkpoint=False):
+        super(Decoder, self).__init__(OrderedDict([
+            ('_conv_1', nn.Conv2d(in_channels=in_channels,
+                                  out_channels=num_hiddens,
+                                  kernel_size=3, 
+                                  stride=1, padding=1)),
+
+            ('_residual_stack', ResidualStack(in_channels=num_hiddens,
+                                              num_hiddens=num_hiddens,
+                                              num_residual_layers=num_residual_layers,
+                                              num_residual_hiddens=num_residual_hiddens,
+                                              use_checkpoint=use_checkpoint)),
+
+            ('_conv_trans_1', nn.ConvTranspose2d(in_channels=num_hiddens, 
+                                                 out_channels=num_hiddens//2,
+                                                 kernel_size=4, 
+                                                 stride=1, padding=2)),
+            ('_relu_1', nn.ReLU(True)),
+
+            ('_conv_trans_2', nn.ConvTranspose2d(in_channels=num_hiddens//2, 
+                                                 out_channels=num_hiddens//2,
+                                                 kernel_size=4, 
+                                                 stride=2, padding=1)),
+            ('_relu_2', nn.ReLU(True)),
+
+            ('_conv_trans_3', nn.ConvTranspose2d(in_channels=num_hiddens//2, 
+                                                 out_channels=out_channels,
+                                                 kernel_size=4, 
+                                                 stride=2, padding=1))
+        ]))
 
 class VQVAE(nn.Module):
     def __init__(self, config, device):
         super(VQVAE, self).__init__()
 
+        # Image size is fixed by the config and only a handful of batch sizes occur, so cuDNN
+        # autotunes a few shapes once and reuses the result
+        torch.backends.cudnn.benchmark = config.cudnn_benchmark
+
+        # TF32 tensor cores for the convs when autocast is off. Matmul TF32 is left at its FP32
+        # default, as the only FP32 matmul left is the quantiser's distance computation
+        torch.backends.cudnn.allow_tf32 = config.allow_tf32
+
         self.device = device
 
         self._num_embeddings = config.num_embeddings
@@ -137,9 +136,13 @@ class VQVAE(nn.Module):
         self.index_dim = config.index_dim
         self._representation_dim = config.representation_dim
 
+        self._use_amp = config.use_amp
+        self._amp_device_type = torch.device(device).type
+
         self._encoder = Encoder(config.num_channels, config.num_hiddens,
                                 config.num_residual_layers, 
-                                config.num_residual_hiddens)
+                                config.num_residual_hiddens,
+                                config.grad_checkpoint)
 
         self._pre_vq_conv = nn.Conv2d(in_channels=config.num_hiddens, 
                                       out_channels=config.num_filters,
@@ -150,79 +153,128 @@ class VQVAE(nn.Module):
                                             config.commitment_cost, config.decay)
         
         self.fit_prior = False
+        self.register_buffer('_zero_loss', torch.zeros(()), persistent=False)
         self.prior = get_prior(config, device)
 
+        # Side stream so the prior can run alongside the decoder when fitting it, None off GPU
+        self._prior_stream = torch.cuda.Stream(device) if torch.device(device).type == 'cuda' else None
+
         self._decoder = Decoder(config.num_filters,
                             config.num_channels,
                             config.num_hiddens, 
                             config.num_residual_layers, 
-                            config.num_residual_hiddens
+                            config.num_residual_hiddens,
+                            config.grad_checkpoint
                         )
 
+        # NHWC lets cuDNN use its native tensor core kernels without hidden permutes
+        self._encoder = self._encoder.to(memory_format=torch.channels_last)
+        self._pre_vq_conv = self._pre_vq_conv.to(memory_format=torch.channels_last)
+        self._decoder = self._decoder.to(memory_format=torch.channels_last)
+
+        # Compiled in place so state dict keys, and hence checkpoints, are unchanged. The batch
+        # size varies (last partial batch, interpolate's doubled batch, sample's single image),
+        # so compile with dynamic shapes rather than specialising and hitting the recompile limit
+        if config.compile:
+            self._encoder.compile(mode='reduce-overhead', fullgraph=True, dynamic=True)
+            self._pre_vq_conv.compile(mode='reduce-overhead', fullgraph=True, dynamic=True)
+            self._decoder.compile(mode='reduce-overhead', fullgraph=True, dynamic=True)
+
+    def _autocast(self, enabled=True):
+        # Codebook distances and lookups are run with enabled=False so they stay in FP32.
+        # CPUs have no bf16 tensor cores, so autocast there would only cost speed and precision
+        return torch.autocast(device_type=self._amp_device_type, dtype=torch.bfloat16,
+                              enabled=self._use_amp and enabled and self._amp_device_type == 'cuda')
+
+    def _lookup_codebook(self, z_indices, codebook):
+        # Quantize, gathering codebook rows rather than multiplying by a one-hot. Indexing
+        # with the BHW indices directly gives BHWC without flattening or permuting them first
+        z_quantised = F.embedding(z_indices.squeeze(1), codebook)
+
+        # The gather is already BHWC, so this permute only relabels strides and does not copy
+        return z_quantised.permute(0, 3, 1, 2).contiguous(memory_format=torch.channels_last)
+
     def sample(self):
-        z_sample_indices = self.prior.sample().type(torch.int64)
-        z_sample_indices = z_sample_indices.permute(0, 2, 3, 1).contiguous()
-        z_sample_indices = z_sample_indices.view(-1, 1)
+        # The quantiser swaps in a new Parameter on every EMA update, so bind per call rather than caching
+        codebook = self._vq_vae._embedding.weight
 
-        z_sample = torch.zeros(z_sample_indices.shape[0], self._num_embeddings, device=self.device)
-        z_sample.scatter_(1, z_sample_indices, 1)
-        
-        # Quantize and unflatten
-        z_quantised = torch.matmul(z_sample, self._vq_vae._embedding.weight).view(1, self._representation_dim, self._representation_dim, self._embedding_dim)
-        z_quantised = z_quantised.permute(0, 3, 1, 2).contiguous()
+        with self._autocast():
+            z_sample_indices = self.prior.sample().type(torch.int64)
+
+            with self._autocast(enabled=False):
+                z_quantised = self._lookup_codebook(z_sample_indices, codebook)
 
-        x_sample = self._decoder(z_quantised)
+            x_sample = self._decoder(z_quantised)
 
-        return x_sample
+        return x_sample.float()
 
     def interpolate(self, x, y):
         if (x.size() == y.size()):
-            zx = self._encoder(x)
-            zx = self._pre_vq_conv(zx)
+            x = x.contiguous(memory_format=torch.channels_last)
+            y = y.contiguous(memory_format=torch.channels_last)
 
-            zy = self._encoder(y)
-            zy = self._pre_vq_conv(zy)
+            with self._autocast():
+                # Encode both endpoints as a single batch
+                z_xy = self._encoder(torch.cat([x, y], dim=0))
+                z_xy = self._pre_vq_conv(z_xy)
 
-            z = (zx + zy) / 2
+                zx, zy = z_xy.chunk(2, dim=0)
+                z = (zx + zy) * 0.5
 
-            _, z_quantised, z_indices = self._vq_vae(z)
+                with self._autocast(enabled=False):
+                    _, z_quantised, z_indices = self._vq_vae(z.float())
 
-            z_denoised_indices = self.prior.reconstruct(z_indices).type(torch.int64)
-            z_denoised_indices = z_denoised_indices.permute(0, 2, 3, 1).contiguous()
-            z_denoised_indices = z_denoised_indices.view(-1, 1)
+                # Bound after quantising, which may have replaced the codebook Parameter
+                codebook = self._vq_vae._embedding.weight
 
-            z_sample = torch.zeros(z_denoised_indices.shape[0], self._num_embeddings, device=self.device)
-            z_sample.scatter_(1, z_denoised_indices, 1)
-            
-            # Quantize and unflatten
-            z_perm_shape = (z.shape[0], self._representation_dim, self._representation_dim, self._embedding_dim)
-            z_quantised = torch.matmul(z_sample, self._vq_vae._embedding.weight).view(z_perm_shape)
-            z_quantised = z_quantised.permute(0, 3, 1, 2).contiguous()
+                z_denoised_indices = self.prior.reconstruct(z_indices).type(torch.int64)
 
-            xy_inter = self._decoder(z_quantised)
+                with self._autocast(enabled=False):
+                    z_quantised = self._lookup_codebook(z_denoised_indices, codebook)
 
-            return xy_inter
+                xy_inter = self._decoder(z_quantised)
+
+            return xy_inter.float()
         return x
 
     def reconstruct(self, x):
         return self.forward(x)
 
     def forward(self, x):
-        z = self._encoder(x)
-        z = self._pre_vq_conv(z)
+        x = x.contiguous(memory_format=torch.channels_last)
+
+        with self._autocast():
+            z = self._encoder(x)
+            z = self._pre_vq_conv(z)
+
+            with self._autocast(enabled=False):
+                quant_loss, z_quantised, z_indices = self._vq_vae(z.float())
+
+            if self.fit_prior:
+                #May need to make indices type long
+                z_targets = z_indices.detach()
+
+                # The prior and decoder only share their inputs, so the prior is queued on a
+                # side stream while the decoder runs on the current one
+                if self._prior_stream is not None:
+                    self._prior_stream.wait_stream(torch.cuda.current_stream())
+                    z_targets.record_stream(self._prior_stream)
+
+                with torch.cuda.stream(self._prior_stream):
+                    z_logits = self.prior(z_targets)
+
+                    z_cross_entropy = F.cross_entropy(z_logits, z_targets, reduction='none')
+                    z_prediction_error = z_cross_entropy.mean(dim=[1,2,3]) * LOG2_E
+                    z_prediction_error = z_prediction_error.mean()            
+                
+                x_recon = self._decoder(z_quantised)
 
-        quant_loss, z_quantised, z_indices = self._vq_vae(z)
+                if self._prior_stream is not None:
+                    torch.cuda.current_stream().wait_stream(self._prior_stream)
+                    z_prediction_error.record_stream(torch.cuda.current_stream())
 
-        if self.fit_prior:
-            #May need to make indices type long
-            z_logits = self.prior(z_indices)
+                return x_recon.float().detach(), quant_loss.detach(), z_prediction_error.float()
 
-            z_cross_entropy = F.cross_entropy(z_logits, z_indices, reduction='none')
-            z_prediction_error = z_cross_entropy.mean(dim=[1,2,3]) * np.log2(np.exp(1))
-            z_prediction_error = z_prediction_error.mean()            
-            
             x_recon = self._decoder(z_quantised)
-            return x_recon.detach(), quant_loss.detach(), z_prediction_error
 
-        x_recon = self._decoder(z_quantised)
-        return x_recon, quant_loss, torch.zeros(1, requires_grad=True).to(self.device)
\ No newline at end of file
+        return x_recon.float(), quant_loss, self._zero_loss
\ No newline at end of file
@@ -34,18 +34,19 @@ class VectorQuantiserEMA(nn.Module):
                     - 2 * torch.matmul(flat_input, self._embedding.weight.t()))
             
         # Encoding
-        encoding_indices = torch.argmin(distances, dim=1).unsqueeze(1)
-        encodings = torch.zeros(encoding_indices.shape[0], self._num_embeddings, device=inputs.device)
-        encodings.scatter_(1, encoding_indices, 1)
+        encoding_indices = torch.argmin(distances, dim=1)
         
         # Quantize and unflatten
-        quantized = torch.matmul(encodings, self._embedding.weight).view(input_shape)
-        encoding_indices = encoding_indices.view(input_shape[0], input_shape[1], input_shape[2], 1)
+        quantized = F.embedding(encoding_indices, self._embedding.weight).view(input_shape)
         
         # Use EMA to update the embedding vectors
         if self.training:
+            # Per-code counts and sums via index_add_ rather than reductions over a one-hot
+            cluster_size = torch.zeros_like(self._ema_cluster_size).index_add_(
+                0, encoding_indices, torch.ones_like(encoding_indices, dtype=self._ema_cluster_size.dtype))
+
             self._ema_cluster_size = self._ema_cluster_size * self._decay + \
-                                     (1 - self._decay) * torch.sum(encodings, 0)
+                                     (1 - self._decay) * cluster_size
             
             # Laplace smoothing of the cluster size
             n = torch.sum(self._ema_cluster_size.data)
@@ -53,7 +54,7 @@ class VectorQuantiserEMA(nn.Module):
                 (self._ema_cluster_size + self._epsilon)
                 / (n + self._num_embeddings * self._epsilon) * n)
             
-            dw = torch.matmul(encodings.t(), flat_input)
+            dw = torch.zeros_like(self._ema_w).index_add_(0, encoding_indices, flat_input.detach())
             self._ema_w = nn.Parameter(self._ema_w * self._decay + (1 - self._decay) * dw)
             
             self._embedding.weight = nn.Parameter(self._ema_w / self._ema_cluster_size.unsqueeze(1))
@@ -64,7 +65,7 @@ class VectorQuantiserEMA(nn.Module):
         
         # Straight Through Estimator
         quantized = inputs + (quantized - inputs).detach()
-        avg_probs = torch.mean(encodings, dim=0)
+        encoding_indices = encoding_indices.view(input_shape[0], input_shape[1], input_shape[2], 1)
         
-        # convert quantized from BHWC -> BCHW
-        return loss, quantized.permute(0, 3, 1, 2).contiguous(), encoding_indices.permute(0, 3, 1, 2).contiguous()
\ No newline at end of file
+        # convert quantized from BHWC -> BCHW, keeping NHWC strides for the channels_last decoder
+        return loss, quantized.permute(0, 3, 1, 2).contiguous(memory_format=torch.channels_last), encoding_indices.permute(0, 3, 1, 2).contiguous()
\ No newline at end of file
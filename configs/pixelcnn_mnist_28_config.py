@@ -25,3 +25,9 @@ config["decay"] = 0.99
 config["prior"] = "PixelCNN"
 config["prior_start"] = 100
 config["index_dim"] = 1
+
+config["use_amp"] = True         # bfloat16 autocast for the conv stacks
+config["compile"] = False        # torch.compile the encoder and decoder
+config["grad_checkpoint"] = False  # recompute residual blocks in backward to save activation memory
+config["cudnn_benchmark"] = True  # autotune conv algorithms, disable for determinism
+config["allow_tf32"] = True       # TF32 tensor cores for FP32 convs
@@ -22,7 +22,7 @@ class Normal(nn.Module):
         self.config = config
 
     def sample(self):
-        return torch.rand(1, self.config.index_dim, self.config.representation_dim, self.config.representation_dim).to(self.device) * (self.config.num_embeddings - 1)
+        return torch.randint(self.config.num_embeddings - 1, (1, self.config.index_dim, self.config.representation_dim, self.config.representation_dim), device=self.device)
     
     def interpolate(self, X, Y):
         return (X + Y) / 2